@@ -3,23 +3,367 @@ import asyncio
 import aiohttp
 import logging
 import json
+import hashlib
+import argparse
+import html
+import sys
+import queue
+import atexit
+import logging.handlers
+import threading
+import traceback
+import cProfile
+import pstats
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 import random
 import time
 from typing import Dict, Any, Tuple
 
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+# 구조화 로그에 포함할 extra 필드들
+LOG_FIELDS = ("chat_id", "model", "latency", "turn")
+
+class JsonFormatter(logging.Formatter):
+    """chat_id/model/latency/turn 필드를 포함한 JSON 한 줄 로그"""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+class TurnLogSampler:
+    """턴마다 찍히는 INFO 로그는 N개 중 1개만 남김 (LogRecord를 만들기 전에 검사)"""
+    def __init__(self, sample_every: int):
+        self.sample_every = max(1, sample_every)
+        self.seen = 0
+
+    def sample(self) -> bool:
+        self.seen += 1
+        return (self.seen - 1) % self.sample_every == 0
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """같은 프로세스 내 큐이므로 레코드를 그대로 넘기고 포맷은 리스너 스레드에서 처리"""
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+class BatchingStreamHandler(logging.StreamHandler):
+    """포맷된 로그를 모아두었다가 flush()에서 한 번에 출력 (쓰기 시스템콜 최소화)"""
+    max_pending = 512
+
+    def __init__(self, stream=None):
+        super().__init__(stream)
+        self.pending = []
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            self.pending.append(self.format(record))
+            if len(self.pending) >= self.max_pending:
+                self.flush()
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            if self.pending and self.stream:
+                self.stream.write("\n".join(self.pending) + self.terminator)
+                self.pending.clear()
+            super().flush()
+        finally:
+            self.release()
+
+class BatchingQueueListener(logging.handlers.QueueListener):
+    """큐가 빌 때마다 핸들러를 flush해서 레코드 단위가 아닌 묶음 단위로 출력"""
+    def __init__(self, log_queue, *handlers, respect_handler_level: bool = False):
+        super().__init__(log_queue, *handlers, respect_handler_level=respect_handler_level)
+        self.running = False
+
+    def start(self):
+        super().start()
+        self.running = True
+
+    def handle(self, record: logging.LogRecord):
+        super().handle(record)
+        if self.queue.empty():
+            for handler in self.handlers:
+                handler.flush()
+
+    def stop(self):
+        """이미 중지된 리스너에 다시 호출해도 안전"""
+        if not self.running:
+            return
+        self.running = False
+        super().stop()
+        for handler in self.handlers:
+            handler.flush()
+
+def setup_logging(stream=None) -> BatchingQueueListener:
+    """QueueHandler → QueueListener 로깅 파이프라인 (포맷과 콘솔 I/O는 별도 스레드에서)"""
+    log_queue = queue.SimpleQueue()
+    
+    stream_handler = BatchingStreamHandler(stream)
+    if os.getenv('LOG_JSON', '').lower() in ('1', 'true', 'yes'):
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    
+    root = logging.getLogger()
+    root.handlers = [LocalQueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    
+    listener = BatchingQueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
 # 로깅 설정
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+log_listener = setup_logging()
+atexit.register(lambda: log_listener is not None and log_listener.stop())
+turn_log_sampler = TurnLogSampler(int(os.getenv('LOG_TURN_SAMPLE', '100')))
 logger = logging.getLogger(__name__)
 
+class MessageRenderer:
+    """모델 출력을 HTML로 미리 이스케이프해서 렌더링 (마크다운 재전송 방지)"""
+    PARSE_MODE = 'HTML'
+    # 짝이 맞지 않으면 레거시 Markdown 파서를 깨뜨리는 엔티티 문자들
+    MARKDOWN_PAIRED = ('*', '_', '`')
+
+    def __init__(self, bot_personas: list):
+        # 페르소나별 헤더 템플릿을 미리 컴파일 (턴마다 이름 이스케이프 생략)
+        self.header_templates = {
+            persona["name"]: "<b>[{count}/{max}]</b> " + html.escape(persona["name"]) + " <code>({model})</code>: "
+            for persona in bot_personas
+        }
+        self.fallbacks_avoided = 0  # 기존 방식이었다면 평문 재전송이 필요했던 메시지 수
+
+    def breaks_markdown(self, text: str) -> bool:
+        """레거시 Markdown으로 보냈다면 파싱 오류가 났을 텍스트인지 확인 (짝이 안 맞는 엔티티 문자)"""
+        for char in self.MARKDOWN_PAIRED:
+            if text.count(char) % 2:
+                return True
+        return text.count('[') != text.count(']')
+
+    def render_turn(self, count: int, max_messages: int, persona_name: str, model_short: str, text: str) -> str:
+        """`[n/max] 페르소나 (모델): 내용` 형식의 대화 메시지 렌더링"""
+        template = self.header_templates.get(persona_name)
+        if template is None:
+            template = "<b>[{count}/{max}]</b> " + html.escape(persona_name) + " <code>({model})</code>: "
+            self.header_templates[persona_name] = template
+        return template.format(count=f"{count:,}", max=f"{max_messages:,}", model=model_short) + html.escape(text, quote=False)
+
+class UsageStats:
+    """토큰 사용량 누적 카운터 (호출당 O(1) 갱신)"""
+    __slots__ = ("calls", "prompt_tokens", "completion_tokens", "total_tokens", "elapsed")
+
+    def __init__(self):
+        self.calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.total_tokens = 0
+        self.elapsed = 0.0  # API 응답 대기 시간 합계 (초)
+
+    def record(self, prompt_tokens: int, completion_tokens: int, total_tokens: int, elapsed: float):
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.total_tokens += total_tokens
+        self.elapsed += elapsed
+
+    @property
+    def tokens_per_sec(self) -> float:
+        """생성 토큰 처리 속도"""
+        return self.completion_tokens / self.elapsed if self.elapsed > 0 else 0.0
+
+class HttpModelBackend:
+    """Nous Research chat/completions HTTP 백엔드"""
+    def __init__(self, api_base_url: str):
+        self.api_base_url = api_base_url
+
+    async def chat_completion(self, api_key: str, payload: dict) -> Tuple[int, Any]:
+        """Returns: (HTTP 상태코드, 성공시 응답 JSON / 실패시 에러 본문)"""
+        headers = {
+            'Authorization': f'Bearer {api_key}',
+            'Content-Type': 'application/json'
+        }
+        async with aiohttp.ClientSession() as session:
+            async with session.post(
+                f"{self.api_base_url}/chat/completions",
+                headers=headers,
+                json=payload,
+                timeout=aiohttp.ClientTimeout(total=30)
+            ) as response:
+                if response.status == 200:
+                    return response.status, await response.json()
+                return response.status, await response.text()
+
+class CannedModelBackend:
+    """시뮬레이션용 고정 응답 백엔드 (시드 고정 RNG로 재현 가능)"""
+    DEFAULT_RESPONSES = [
+        "흥미로운 관점이네! 그런데 반대로 생각해보면 어떨까?",
+        "맞아, 나도 비슷하게 느꼈어. 특히 감정적인 부분이 크다고 생각해.",
+        "데이터로 보면 조금 다른 결론이 나올 수도 있을 것 같아.",
+        "그 말을 들으니 예전에 읽었던 이야기가 떠오르네.",
+        "좋은 질문이야. 우리가 당연하게 여기는 전제부터 다시 보자.",
+        "현실적으로 적용하려면 어떤 단계가 필요할까?",
+        "상상해보면 정말 멋진 세상이 될 것 같아, 그치?",
+        "음, 나는 조금 회의적이야. 부작용도 분명히 있을 테니까.",
+    ]
+
+    def __init__(self, seed: int = None, responses: list = None, fail_rate_405b: float = 0.0):
+        self.rng = random.Random(seed)
+        self.responses = responses or self.DEFAULT_RESPONSES
+        self.fail_rate_405b = fail_rate_405b  # 405B 실패 비율 (70B 폴백 경로 검증용)
+
+    async def chat_completion(self, api_key: str, payload: dict) -> Tuple[int, Any]:
+        if "405B" in payload["model"] and self.rng.random() < self.fail_rate_405b:
+            return 503, "simulated overload"
+        content = self.rng.choice(self.responses)
+        prompt_tokens = sum(len(message["content"].split()) for message in payload["messages"])
+        completion_tokens = len(content.split())
+        return 200, {
+            "choices": [{"message": {"role": "assistant", "content": content}}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens
+            }
+        }
+
+class ReplayModelBackend:
+    """기록된 chat/completions 응답(JSONL, 한 줄에 응답 JSON 하나)을 순서대로 재생"""
+    def __init__(self, path: str):
+        self.records = []
+        with open(path, encoding='utf-8') as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{path}:{lineno}: JSON 파싱 실패 ({e.msg})") from None
+                if not self.is_completion(record):
+                    raise ValueError(f"{path}:{lineno}: chat/completions 응답 형식이 아닙니다 (choices[0].message.content 필요)")
+                self.records.append(record)
+        if not self.records:
+            raise ValueError(f"재생할 응답이 없습니다: {path}")
+        self.position = 0
+
+    @staticmethod
+    def is_completion(record: Any) -> bool:
+        """choices[0].message.content 문자열이 있는 응답인지 확인"""
+        if not isinstance(record, dict):
+            return False
+        choices = record.get('choices')
+        if not isinstance(choices, list) or not choices or not isinstance(choices[0], dict):
+            return False
+        message = choices[0].get('message')
+        return isinstance(message, dict) and isinstance(message.get('content'), str)
+
+    async def chat_completion(self, api_key: str, payload: dict) -> Tuple[int, Any]:
+        record = self.records[self.position % len(self.records)]
+        self.position += 1
+        return 200, record
+
+class VirtualClock:
+    """asyncio.sleep 대신 시간만 앞으로 돌리는 가상 시계"""
+    def __init__(self, start: float = 0.0):
+        self.current = start
+
+    def now(self) -> float:
+        return self.current
+
+    async def sleep(self, seconds: float):
+        self.current += seconds
+        await asyncio.sleep(0)  # 다른 태스크에 양보만 하고 실제로 기다리지 않음
+
+class LoopLagMonitor:
+    """이벤트 루프 스케줄링 지연 측정 (느린 콜백 감지 + 선택적 스택 샘플링)"""
+    MIN_WATCHDOG_POLL = 0.01  # 워치독 스레드 최소 확인 주기 (초)
+    def __init__(self, interval: float = 0.5, threshold: float = 0.1, sample_stacks: bool = False):
+        self.interval = interval
+        self.threshold = threshold  # 이 시간(초) 이상 늦어지면 느린 콜백으로 간주
+        self.sample_stacks = sample_stacks
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.last_lag = 0.0
+        self.slow_count = 0
+        self.heartbeat = time.monotonic()
+        self.task = None
+        self.loop_thread_id = None
+        self.stalled = False  # 현재 정체 구간의 스택을 이미 샘플링했는지
+        self.stopping = threading.Event()
+
+    @property
+    def avg_lag(self) -> float:
+        return self.total_lag / self.samples if self.samples else 0.0
+
+    def start(self):
+        """실행 중인 이벤트 루프에서 모니터 시작"""
+        self.loop_thread_id = threading.get_ident()
+        self.heartbeat = time.monotonic()
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        if self.sample_stacks:
+            threading.Thread(target=self.watchdog, name="loop-lag-watchdog", daemon=True).start()
+        logger.info(f"이벤트 루프 모니터 시작 (주기 {self.interval*1000:.0f}ms, 임계값 {self.threshold*1000:.0f}ms)")
+
+    async def stop(self):
+        """모니터 태스크 취소 및 워치독 스레드 종료"""
+        self.stopping.set()
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - scheduled - self.interval)
+            self.heartbeat = time.monotonic()
+            self.stalled = False
+            self.samples += 1
+            self.total_lag += lag
+            self.last_lag = lag
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag > self.threshold:
+                self.slow_count += 1
+                logger.warning(f"이벤트 루프 지연 감지: {lag*1000:.1f}ms", extra={"latency": round(lag, 4)})
+
+    def watchdog(self):
+        """루프가 멈춘 동안 루프 스레드의 스택을 샘플링 (별도 스레드)"""
+        poll = max(self.threshold / 2, self.MIN_WATCHDOG_POLL)
+        while not self.stopping.wait(poll):
+            stalled_for = time.monotonic() - self.heartbeat - self.interval
+            if stalled_for <= self.threshold or self.stalled:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            self.stalled = True
+            stack = "".join(traceback.format_stack(frame, limit=8))
+            logger.warning(f"느린 콜백 스택 ({stalled_for*1000:.0f}ms 이상 정체):\n{stack}",
+                           extra={"latency": round(stalled_for, 4)})
+
 class UserSession:
     """사용자별 세션 클래스"""
-    def __init__(self, chat_id: int):
+    def __init__(self, chat_id: int, seed: int = None):
         self.chat_id = chat_id
+        self.rng = random.Random(seed)  # 세션별 RNG (시드 지정시 재현 가능)
         self.nous_api_key = None
         self.chat_active = False
         self.chat_count = 0
@@ -33,14 +377,56 @@ class UserSession:
         self.current_model = None  # 현재 실제 사용 중인 모델
         self.model_attempts = {"405B": 0, "70B": 0}  # 모델별 시도 횟수
         self.model_successes = {"405B": 0, "70B": 0}  # 모델별 성공 횟수
+        self.markdown_fallbacks_avoided = 0  # 사전 이스케이프로 피한 평문 재전송 횟수
+        self.plain_text_fallbacks = 0  # 실제 평문 재전송 횟수
+        self.usage = UsageStats()  # 세션 전체 토큰 사용량
+        self.model_usage = {"405B": UsageStats(), "70B": UsageStats()}  # 모델별 토큰 사용량
+        self.conversation_usage = UsageStats()  # 현재 대화의 토큰 사용량 (예산 기준)
+        self.token_budget = None  # 대화당 토큰 예산 (None이면 무제한)
+        self.budget_action = "downgrade"  # 예산 초과시 동작: "downgrade"(70B 전환) 또는 "stop"
+        self.budget_exceeded = False
+        self.budget_notified = False  # 예산 초과 안내(및 중지/전환 처리) 여부
 
 class BotChatSystem:
     def __init__(self):
         self.bot_token = os.getenv('TELEGRAM_BOT_TOKEN')
         self.user_sessions: Dict[int, UserSession] = {}
+        self.key_usage: Dict[str, UsageStats] = {}  # API 키별 토큰 사용량
+        
+        # 관리자 및 이벤트 루프 모니터링 설정
+        self.admin_ids = set()
+        for raw_id in os.getenv('ADMIN_CHAT_IDS', '').split(','):
+            raw_id = raw_id.strip()
+            if not raw_id:
+                continue
+            try:
+                self.admin_ids.add(int(raw_id))
+            except ValueError:
+                logger.warning(f"ADMIN_CHAT_IDS의 잘못된 값 무시: {raw_id!r}")
+        
+        self.loop_monitor = None
+        if os.getenv('LOOP_MONITOR', '').lower() in ('1', 'true', 'yes'):
+            try:
+                threshold_ms = float(os.getenv('LOOP_LAG_THRESHOLD_MS', '100'))
+            except ValueError:
+                threshold_ms = 0.0
+            if not threshold_ms > 0:  # 0, 음수, nan 모두 거부
+                logger.warning(f"LOOP_LAG_THRESHOLD_MS 값은 0보다 큰 숫자여야 합니다: {os.getenv('LOOP_LAG_THRESHOLD_MS')!r} (기본값 100ms 사용)")
+                threshold_ms = 100.0
+            self.loop_monitor = LoopLagMonitor(
+                threshold=threshold_ms / 1000,
+                sample_stacks=os.getenv('LOOP_STACK_SAMPLING', '').lower() in ('1', 'true', 'yes')
+            )
+        self.profiling = False
         
         # 실제 Nous Research API 설정
         self.api_base_url = "https://inference-api.nousresearch.com/v1"
+        self.backend = HttpModelBackend(self.api_base_url)
+        
+        # 시계 (시뮬레이션 모드에서는 VirtualClock으로 교체)
+        self.now = time.time
+        self.monotonic = time.monotonic
+        self.sleep = asyncio.sleep
         
         # 사용 가능한 모델들
         self.available_models = {
@@ -121,6 +507,9 @@ class BotChatSystem:
             }
         ]
 
+        # 대화 메시지 렌더러 (HTML 사전 이스케이프)
+        self.renderer = MessageRenderer(self.bot_personas)
+
     def get_user_session(self, chat_id: int) -> UserSession:
         """사용자별 세션 가져오기 (없으면 생성)"""
         if chat_id not in self.user_sessions:
@@ -128,21 +517,48 @@ class BotChatSystem:
             logger.info(f"새 사용자 세션 생성: {chat_id}")
         return self.user_sessions[chat_id]
 
+    @staticmethod
+    def api_key_preview(api_key: str) -> str:
+        """API 키 일부만 표시"""
+        return f"{api_key[:8]}...{api_key[-4:]}" if api_key else "미설정"
+
+    def record_usage(self, user_session: UserSession, model_name: str, usage: dict, elapsed: float):
+        """API 응답의 usage 블록을 세션/모델/키별로 누적"""
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        completion_tokens = usage.get('completion_tokens') or 0
+        total_tokens = usage.get('total_tokens') or (prompt_tokens + completion_tokens)
+        
+        user_session.usage.record(prompt_tokens, completion_tokens, total_tokens, elapsed)
+        user_session.model_usage[model_name].record(prompt_tokens, completion_tokens, total_tokens, elapsed)
+        user_session.conversation_usage.record(prompt_tokens, completion_tokens, total_tokens, elapsed)
+        
+        key_stats = self.key_usage.get(user_session.nous_api_key)
+        if key_stats is None:
+            key_stats = self.key_usage[user_session.nous_api_key] = UsageStats()
+        key_stats.record(prompt_tokens, completion_tokens, total_tokens, elapsed)
+        
+        if (user_session.token_budget is not None and not user_session.budget_exceeded
+                and user_session.conversation_usage.total_tokens >= user_session.token_budget):
+            user_session.budget_exceeded = True
+            logger.info(f"사용자 {user_session.chat_id}: 토큰 예산 초과 ({user_session.conversation_usage.total_tokens:,}/{user_session.token_budget:,})")
+
+    def format_usage(self, stats: UsageStats) -> str:
+        """토큰 사용량 한 줄 요약"""
+        return (f"{stats.total_tokens:,} 토큰 (입력 {stats.prompt_tokens:,} / 출력 {stats.completion_tokens:,}, "
+                f"{stats.tokens_per_sec:.1f} 토큰/초)")
+
     async def try_api_call(self, user_session: UserSession, data: dict) -> Tuple[bool, str, str]:
         """
         API 호출 시도 (405B → 70B 순서로)
         Returns: (성공여부, 응답내용, 사용된모델)
         """
-        headers = {
-            'Authorization': f'Bearer {user_session.nous_api_key}',
-            'Content-Type': 'application/json'
-        }
-        
-        # 405B 먼저 시도
+        # 405B 먼저 시도 (토큰 예산 초과로 다운그레이드된 경우 70B만)
         models_to_try = [
             ("405B", self.available_models["405B"]),
             ("70B", self.available_models["70B"])
         ]
+        if user_session.budget_exceeded and user_session.budget_action == "downgrade":
+            models_to_try = models_to_try[1:]
         
         for model_name, model_id in models_to_try:
             try:
@@ -150,38 +566,41 @@ class BotChatSystem:
                 data_copy = data.copy()
                 data_copy["model"] = model_id
                 
-                async with aiohttp.ClientSession() as session:
-                    async with session.post(
-                        f"{self.api_base_url}/chat/completions",
-                        headers=headers,
-                        json=data_copy,
-                        timeout=aiohttp.ClientTimeout(total=30)
-                    ) as response:
-                        
-                        if response.status == 200:
-                            result = await response.json()
-                            content = result.get('choices', [{}])[0].get('message', {}).get('content', 'No response')
-                            user_session.model_successes[model_name] += 1
-                            user_session.current_model = model_id
-                            
-                            # 405B 성공시 로그
-                            if model_name == "405B":
-                                logger.info(f"사용자 {user_session.chat_id}: 405B 모델 성공")
-                            elif model_name == "70B":
-                                logger.info(f"사용자 {user_session.chat_id}: 405B 실패 → 70B 폴백 성공")
-                            
-                            return True, content.strip(), model_id
-                        else:
-                            error_text = await response.text()
-                            logger.warning(f"사용자 {user_session.chat_id}: {model_name} 모델 실패 (HTTP {response.status})")
-                            
-                            # 405B 실패시 70B로 계속, 70B도 실패시 에러 반환
-                            if model_name == "70B":
-                                return False, f"모든 모델 실패: {error_text}", None
-                            continue
-                            
+                started = self.monotonic()
+                status, result = await self.backend.chat_completion(user_session.nous_api_key, data_copy)
+                
+                if status == 200:
+                    content = result.get('choices', [{}])[0].get('message', {}).get('content', 'No response')
+                    self.record_usage(user_session, model_name, result.get('usage') or {}, self.monotonic() - started)
+                    user_session.model_successes[model_name] += 1
+                    user_session.current_model = model_id
+                    
+                    # 성공 로그 (턴마다 발생하므로 샘플링된 경우에만 레코드 생성)
+                    if turn_log_sampler.sample():
+                        log_fields = {
+                            "chat_id": user_session.chat_id,
+                            "model": model_name,
+                            "latency": round(self.monotonic() - started, 3),
+                            "turn": user_session.chat_count + 1
+                        }
+                        if model_name == "405B":
+                            logger.info("사용자 %s: 405B 모델 성공", user_session.chat_id, extra=log_fields)
+                        elif model_name == "70B":
+                            logger.info("사용자 %s: 405B 실패 → 70B 폴백 성공", user_session.chat_id, extra=log_fields)
+                    
+                    return True, content.strip(), model_id
+                else:
+                    logger.warning(f"사용자 {user_session.chat_id}: {model_name} 모델 실패 (HTTP {status})",
+                                   extra={"chat_id": user_session.chat_id, "model": model_name, "turn": user_session.chat_count + 1})
+                    
+                    # 405B 실패시 70B로 계속, 70B도 실패시 에러 반환
+                    if model_name == "70B":
+                        return False, f"모든 모델 실패: {result}", None
+                    continue
+                    
             except Exception as e:
-                logger.error(f"사용자 {user_session.chat_id}: {model_name} 모델 호출 오류: {e}")
+                logger.error(f"사용자 {user_session.chat_id}: {model_name} 모델 호출 오류: {e}",
+                             extra={"chat_id": user_session.chat_id, "model": model_name, "turn": user_session.chat_count + 1})
                 if model_name == "70B":
                     return False, f"API 호출 실패: {str(e)}", None
                 continue
@@ -247,7 +666,7 @@ class BotChatSystem:
         
         data = {
             "messages": messages,
-            "temperature": random.uniform(0.7, 0.9),
+            "temperature": user_session.rng.uniform(0.7, 0.9),
             "max_tokens": 512,
             "top_p": 0.9
         }
@@ -279,6 +698,7 @@ class BotChatSystem:
             f"• `/stop_chat` - ⏹️ 대화 중지\n"
             f"• `/status` - 📊 내 상태 확인\n"
             f"• `/model_stats` - 🧠 모델 사용 통계\n"
+            f"• `/token_budget` - 💰 토큰 예산 설정\n"
             f"• `/clear` - 🗑️ 대화 기록 초기화\n"
             f"• `/help` - ❓ 도움말\n"
             f"• `/global_status` - 🌍 전체 사용자 현황\n\n"
@@ -321,19 +741,75 @@ class BotChatSystem:
             f"🧠 **Hermes-3-405B:**\n"
             f"• 시도: {user_session.model_attempts['405B']}회\n"
             f"• 성공: {user_session.model_successes['405B']}회\n"
-            f"• 성공률: {success_rate_405b:.1f}%\n\n"
+            f"• 성공률: {success_rate_405b:.1f}%\n"
+            f"• 사용량: {self.format_usage(user_session.model_usage['405B'])}\n\n"
             f"⚡ **Hermes-3-70B:**\n"
             f"• 시도: {user_session.model_attempts['70B']}회\n"
             f"• 성공: {user_session.model_successes['70B']}회\n"
-            f"• 성공률: {success_rate_70b:.1f}%\n\n"
+            f"• 성공률: {success_rate_70b:.1f}%\n"
+            f"• 사용량: {self.format_usage(user_session.model_usage['70B'])}\n\n"
             f"📈 **전체 통계:**\n"
             f"• 총 시도: {total_attempts}회\n"
             f"• 총 성공: {total_successes}회\n"
-            f"• 전체 성공률: {total_successes/total_attempts*100:.1f}%\n\n"
+            f"• 전체 성공률: {total_successes/total_attempts*100:.1f}%\n"
+            f"• 총 사용량: {self.format_usage(user_session.usage)}\n\n"
+            f"✉️ **메시지 전송:**\n"
+            f"• 재전송 회피: {user_session.markdown_fallbacks_avoided}회\n"
+            f"• 평문 재전송: {user_session.plain_text_fallbacks}회\n\n"
             f"💡 405B 우선, 실패시 70B 자동 전환",
             parse_mode='Markdown'
         )
 
+    async def token_budget_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """토큰 예산 설정 명령어 (/token_budget <토큰수|off> [downgrade|stop])"""
+        chat_id = update.effective_chat.id
+        user_session = self.get_user_session(chat_id)
+        args = context.args or []
+        
+        if not args:
+            budget_text = f"{user_session.token_budget:,} 토큰" if user_session.token_budget is not None else "무제한"
+            await update.message.reply_text(
+                f"💰 **토큰 예산** 💰\n\n"
+                f"🆔 세션 ID: `{chat_id}`\n"
+                f"• 현재 예산: {budget_text}\n"
+                f"• 초과시 동작: {user_session.budget_action}\n"
+                f"• 현재 대화 사용량: {user_session.conversation_usage.total_tokens:,} 토큰\n\n"
+                f"📋 **사용법:**\n"
+                f"• `/token_budget 100000` - 초과시 70B 전환\n"
+                f"• `/token_budget 100000 stop` - 초과시 대화 중지\n"
+                f"• `/token_budget off` - 예산 해제",
+                parse_mode='Markdown'
+            )
+            return
+        
+        if args[0].lower() == "off":
+            user_session.token_budget = None
+            user_session.budget_exceeded = False
+            user_session.budget_notified = False
+            await update.message.reply_text("💰 토큰 예산이 해제되었습니다. (무제한)")
+            return
+        
+        action = args[1].lower() if len(args) > 1 else "downgrade"
+        try:
+            budget = int(args[0].replace(',', ''))
+        except ValueError:
+            budget = 0
+        if budget <= 0 or action not in ("downgrade", "stop"):
+            await update.message.reply_text("❌ 사용법: `/token_budget <토큰수|off> [downgrade|stop]`", parse_mode='Markdown')
+            return
+        
+        user_session.token_budget = budget
+        user_session.budget_action = action
+        user_session.budget_exceeded = user_session.conversation_usage.total_tokens >= budget
+        user_session.budget_notified = False  # 새 예산 기준으로 다시 안내/처리
+        action_text = "70B 모델로 전환" if action == "downgrade" else "대화 중지"
+        await update.message.reply_text(
+            f"💰 **토큰 예산 설정 완료!**\n\n"
+            f"• 예산: {budget:,} 토큰 (대화당)\n"
+            f"• 초과시: {action_text}",
+            parse_mode='Markdown'
+        )
+
     async def global_status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """전체 사용자 현황 명령어"""
         total_users = len(self.user_sessions)
@@ -354,19 +830,70 @@ class BotChatSystem:
         
         status_text += f"🧠 **모델 사용 현황:**\n"
         status_text += f"• 405B 시도: {total_405b_attempts}회 (성공: {total_405b_successes}회)\n"
-        status_text += f"• 70B 시도: {total_70b_attempts}회 (성공: {total_70b_successes}회)\n\n"
+        status_text += f"• 70B 시도: {total_70b_attempts}회 (성공: {total_70b_successes}회)\n"
+        status_text += f"• 총 토큰: {sum(stats.total_tokens for stats in self.key_usage.values()):,}개 (API 키 {len(self.key_usage)}개)\n\n"
+        
+        total_plain_fallbacks = sum(session.plain_text_fallbacks for session in self.user_sessions.values())
+        status_text += f"✉️ **메시지 전송:**\n"
+        status_text += f"• 재전송 회피: {self.renderer.fallbacks_avoided:,}회\n"
+        status_text += f"• 평문 재전송: {total_plain_fallbacks:,}회\n\n"
+        
+        if self.loop_monitor:
+            status_text += f"⏱️ **이벤트 루프 지연:**\n"
+            status_text += f"• 평균: {self.loop_monitor.avg_lag*1000:.1f}ms / 최대: {self.loop_monitor.max_lag*1000:.1f}ms\n"
+            status_text += f"• 임계값 초과: {self.loop_monitor.slow_count}회\n\n"
         
         if active_users > 0:
             status_text += f"🔥 **진행 중인 대화들:**\n"
             for chat_id, session in self.user_sessions.items():
                 if session.chat_active:
-                    duration = time.time() - session.start_time if session.start_time else 0
+                    duration = self.now() - session.start_time if session.start_time else 0
                     speed = session.chat_count / (duration/60) if duration > 0 else 0
                     current_model = "405B" if session.current_model and "405B" in session.current_model else "70B"
                     status_text += f"• 사용자 `{chat_id}`: {session.chat_count:,}개 ({speed:.1f}/분, {current_model})\n"
         
         await update.message.reply_text(status_text, parse_mode='Markdown')
 
+    async def profile_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """실행 중인 봇 프로파일링 (관리자 전용, /profile [초])"""
+        user = update.effective_user
+        if user is None or user.id not in self.admin_ids:
+            await update.message.reply_text("❌ 관리자 전용 명령어입니다.")
+            return
+        if self.profiling:
+            await update.message.reply_text("⚠️ 이미 프로파일링이 진행 중입니다.")
+            return
+        
+        try:
+            seconds = min(max(int(context.args[0]), 1), 60) if context.args else 10
+        except ValueError:
+            seconds = 10
+        
+        # 다른 업데이트 처리를 막지 않도록 백그라운드 태스크로 실행하고 끝나면 결과 전송
+        self.profiling = True
+        context.application.create_task(self.run_profile(update, seconds))
+        await update.message.reply_text(f"🔬 {seconds}초 동안 프로파일링합니다... 끝나면 결과를 보내드립니다. ⏳")
+
+    async def run_profile(self, update: Update, seconds: int):
+        """프로파일링 실행 후 자체 실행 시간 기준 상위 함수 전송"""
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            await asyncio.sleep(seconds)
+        finally:
+            profiler.disable()
+            self.profiling = False
+        
+        # 자체 실행 시간(tottime) 기준 상위 함수들
+        stats = pstats.Stats(profiler).stats
+        top = sorted(stats.items(), key=lambda item: item[1][2], reverse=True)[:15]
+        lines = [f"🔬 프로파일 결과 ({seconds}초, 자체 시간 기준 상위 {len(top)}개)", ""]
+        for (filename, lineno, func_name), (_, ncalls, tottime, cumtime, _) in top:
+            location = f"{os.path.basename(filename)}:{lineno}" if lineno else filename
+            lines.append(f"{tottime*1000:8.1f}ms / 누적 {cumtime*1000:8.1f}ms  {ncalls:>6}회  {func_name} ({location})")
+        
+        await update.message.reply_text("\n".join(lines)[:4000])
+
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """도움말 명령어"""
         await update.message.reply_text(
@@ -375,6 +902,7 @@ class BotChatSystem:
             "⏹️ `/stop_chat` - 대화 즉시 중지\n"
             "📊 `/status` - 나의 현재 상태\n"
             "🧠 `/model_stats` - 모델 사용 통계\n"
+            "💰 `/token_budget` - 대화당 토큰 예산 설정\n"
             "🌍 `/global_status` - 전체 사용자 현황\n"
             "🗑️ `/clear` - 대화 기록 완전 삭제\n"
             "❓ `/help` - 이 도움말 보기\n\n"
@@ -452,6 +980,22 @@ class BotChatSystem:
                     parse_mode='Markdown'
                 )
 
+    def begin_conversation(self, user_session: UserSession) -> Tuple[str, str]:
+        """대화 상태 초기화 후 시작 주제 선택 (Returns: (주제 카테고리, 시작 메시지))"""
+        user_session.chat_active = True
+        user_session.chat_count = 0
+        user_session.conversation_history = []
+        user_session.last_responses = []
+        user_session.start_time = self.now()
+        user_session.conversation_usage = UsageStats()
+        user_session.budget_exceeded = False
+        user_session.budget_notified = False
+        
+        # 랜덤 주제 선택
+        topic_category = user_session.rng.choice(list(self.starter_topics.keys()))
+        starter_message = user_session.rng.choice(self.starter_topics[topic_category])
+        return topic_category, starter_message
+
     async def start_chat_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """봇 대화 시작"""
         chat_id = update.effective_chat.id
@@ -477,15 +1021,7 @@ class BotChatSystem:
             )
             return
             
-        user_session.chat_active = True
-        user_session.chat_count = 0
-        user_session.conversation_history = []
-        user_session.last_responses = []
-        user_session.start_time = time.time()
-        
-        # 랜덤 주제 선택
-        topic_category = random.choice(list(self.starter_topics.keys()))
-        starter_message = random.choice(self.starter_topics[topic_category])
+        topic_category, starter_message = self.begin_conversation(user_session)
         
         await update.message.reply_text(
             f"🚀 **스마트 무한 대화 시작!** 🚀\n\n"
@@ -526,7 +1062,7 @@ class BotChatSystem:
         if user_session.current_task:
             user_session.current_task.cancel()
             
-        duration = time.time() - user_session.start_time if user_session.start_time else 0
+        duration = self.now() - user_session.start_time if user_session.start_time else 0
         current_model = "405B" if user_session.current_model and "405B" in user_session.current_model else "70B"
         
         await update.message.reply_text(
@@ -553,12 +1089,18 @@ class BotChatSystem:
         api_status = "✅ 설정됨" if user_session.nous_api_key else "❌ 미설정"
         chat_status = "🟢 진행중" if user_session.chat_active else "🔴 중지됨"
         
-        if user_session.nous_api_key:
-            api_key_preview = f"{user_session.nous_api_key[:8]}...{user_session.nous_api_key[-4:]}"
+        api_key_preview = self.api_key_preview(user_session.nous_api_key)
+        key_stats = self.key_usage.get(user_session.nous_api_key) if user_session.nous_api_key else None
+        key_usage_text = self.format_usage(key_stats) if key_stats else "기록 없음"
+        
+        if user_session.token_budget is None:
+            budget_text = "무제한"
         else:
-            api_key_preview = "미설정"
+            action_text = "70B 전환" if user_session.budget_action == "downgrade" else "중지"
+            budget_text = (f"{user_session.conversation_usage.total_tokens:,}/{user_session.token_budget:,} "
+                           f"(초과시 {action_text}{', 초과됨' if user_session.budget_exceeded else ''})")
             
-        duration = time.time() - user_session.start_time if user_session.start_time and user_session.chat_active else 0
+        duration = self.now() - user_session.start_time if user_session.start_time and user_session.chat_active else 0
         speed = user_session.chat_count / (duration/60) if duration > 0 else 0
         
         current_model = "405B" if user_session.current_model and "405B" in user_session.current_model else "70B" if user_session.current_model else "미설정"
@@ -572,7 +1114,10 @@ class BotChatSystem:
             f"📝 **진행도:** {user_session.chat_count:,}/{user_session.max_messages:,} ({user_session.chat_count/user_session.max_messages*100:.1f}%)\n"
             f"🗂️ **히스토리:** {len(user_session.conversation_history)}개\n"
             f"⏱️ **경과시간:** {duration/60:.1f}분\n"
-            f"⚡ **평균속도:** {speed:.1f}개/분\n\n"
+            f"⚡ **평균속도:** {speed:.1f}개/분\n"
+            f"🔢 **토큰(대화):** {self.format_usage(user_session.conversation_usage)}\n"
+            f"🔑 **토큰(API 키):** {key_usage_text}\n"
+            f"💰 **토큰 예산:** {budget_text}\n\n"
             f"🧠 **모델 통계:** `/model_stats` 확인\n"
             f"🌍 **전체 현황:** `/global_status` 확인",
             parse_mode='Markdown'
@@ -617,8 +1162,8 @@ class BotChatSystem:
             while user_session.chat_active and user_session.chat_count < user_session.max_messages:
                 try:
                     # 봇 선택
-                    if random.random() < 0.3:
-                        current_bot_index = random.randint(0, len(self.bot_personas) - 1)
+                    if user_session.rng.random() < 0.3:
+                        current_bot_index = user_session.rng.randint(0, len(self.bot_personas) - 1)
                     else:
                         current_bot_index = (current_bot_index + 1) % len(self.bot_personas)
                     
@@ -635,16 +1180,18 @@ class BotChatSystem:
                                 "❌ **연속 API 오류로 대화를 중지합니다.**\n\n"
                                 "잠시 후 다시 시도해주세요.")
                             break
-                        await asyncio.sleep(10)
+                        await self.sleep(10)
                         continue
                     
                     consecutive_failures = 0  # 성공시 실패 카운터 초기화
                     
                     # 무한 루프 방지
                     if self.is_repetitive_response(user_session, response):
-                        topic_category = random.choice(list(self.starter_topics.keys()))
-                        response = random.choice(self.starter_topics[topic_category])
-                        logger.info(f"사용자 {user_session.chat_id}: 반복 감지 - 새 주제로 전환")
+                        topic_category = user_session.rng.choice(list(self.starter_topics.keys()))
+                        response = user_session.rng.choice(self.starter_topics[topic_category])
+                        if turn_log_sampler.sample():
+                            logger.info("사용자 %s: 반복 감지 - 새 주제로 전환", user_session.chat_id,
+                                        extra={"chat_id": user_session.chat_id, "turn": user_session.chat_count + 1})
                     
                     # 응답 기록
                     user_session.last_responses.append(response)
@@ -656,14 +1203,23 @@ class BotChatSystem:
                     # 현재 사용 중인 모델 표시
                     current_model_short = "405B" if user_session.current_model and "405B" in user_session.current_model else "70B"
                     
-                    # 메시지 전송
-                    display_message = f"**[{user_session.chat_count:,}/{user_session.max_messages:,}]** {bot['name']} `({current_model_short})`: {response}"
+                    # 메시지 전송 (HTML로 미리 이스케이프해서 한 번에 성공하도록)
+                    display_message = self.renderer.render_turn(
+                        user_session.chat_count, user_session.max_messages,
+                        bot['name'], current_model_short, response
+                    )
                     
-                    success = await self.send_message_to_user(user_session.chat_id, display_message)
-                    if not success:
-                        # 마크다운 실패시 일반 텍스트로 재시도
+                    success = await self.send_message_to_user(user_session.chat_id, display_message, parse_mode=MessageRenderer.PARSE_MODE)
+                    if success:
+                        if self.renderer.breaks_markdown(response):
+                            user_session.markdown_fallbacks_avoided += 1
+                            self.renderer.fallbacks_avoided += 1
+                    else:
+                        # 렌더링 실패시에만 일반 텍스트로 재시도
+                        user_session.plain_text_fallbacks += 1
                         await self.send_message_to_user(user_session.chat_id, 
-                            f"[{user_session.chat_count:,}/{user_session.max_messages:,}] {bot['name']} ({current_model_short}): {response}")
+                            f"[{user_session.chat_count:,}/{user_session.max_messages:,}] {bot['name']} ({current_model_short}): {response}",
+                            parse_mode=None)
                     
                     # 대화 히스토리 업데이트
                     user_session.conversation_history.append({"role": "assistant", "content": response})
@@ -675,14 +1231,14 @@ class BotChatSystem:
                     # 주기적 새 주제 도입
                     topic_change_counter += 1
                     if topic_change_counter >= 50:
-                        topic_category = random.choice(list(self.starter_topics.keys()))
-                        new_topic = random.choice(self.starter_topics[topic_category])
+                        topic_category = user_session.rng.choice(list(self.starter_topics.keys()))
+                        new_topic = user_session.rng.choice(self.starter_topics[topic_category])
                         current_message = f"{response} 그런데 {new_topic}"
                         topic_change_counter = 0
                     
                     # 1000개마다 모델 통계 리포트
                     if user_session.chat_count % 1000 == 0:
-                        duration = time.time() - user_session.start_time
+                        duration = self.now() - user_session.start_time
                         total_405b = user_session.model_successes["405B"]
                         total_70b = user_session.model_successes["70B"]
                         
@@ -691,21 +1247,36 @@ class BotChatSystem:
                             f"⏱️ 경과: {duration/3600:.1f}시간\n"
                             f"⚡ 속도: {user_session.chat_count/(duration/60):.1f}개/분\n"
                             f"🧠 405B 사용: {total_405b}회\n"
-                            f"⚡ 70B 사용: {total_70b}회\n\n"
+                            f"⚡ 70B 사용: {total_70b}회\n"
+                            f"🔢 토큰: {self.format_usage(user_session.conversation_usage)}\n\n"
                             f"🚀 계속 진행중...")
                     
-                    await asyncio.sleep(random.uniform(2, 6))
+                    # 토큰 예산 초과 처리
+                    if user_session.budget_exceeded and not user_session.budget_notified:
+                        user_session.budget_notified = True
+                        if user_session.budget_action == "stop":
+                            await self.send_message_to_user(user_session.chat_id,
+                                f"💰 **토큰 예산 초과로 대화를 중지합니다.**\n\n"
+                                f"• 사용량: {self.format_usage(user_session.conversation_usage)}\n"
+                                f"• 예산: {user_session.token_budget:,} 토큰")
+                            break
+                        await self.send_message_to_user(user_session.chat_id,
+                            f"💰 **토큰 예산 초과 - 이후 70B 모델로 전환합니다.**\n\n"
+                            f"• 사용량: {self.format_usage(user_session.conversation_usage)}\n"
+                            f"• 예산: {user_session.token_budget:,} 토큰")
+                    
+                    await self.sleep(user_session.rng.uniform(2, 6))
                     
                 except asyncio.CancelledError:
                     logger.info(f"사용자 {user_session.chat_id}: 대화 태스크 취소됨")
                     break
                 except Exception as e:
                     logger.error(f"사용자 {user_session.chat_id} 대화 중 오류: {e}")
-                    await asyncio.sleep(10)
+                    await self.sleep(10)
             
             # 대화 종료
             user_session.chat_active = False
-            duration = time.time() - user_session.start_time
+            duration = self.now() - user_session.start_time
             
             await self.send_message_to_user(user_session.chat_id,
                 f"🏁 **대화 완료!** 🏁\n\n"
@@ -714,7 +1285,8 @@ class BotChatSystem:
                 f"• 소요시간: **{duration/3600:.1f}**시간\n"
                 f"• 평균속도: **{user_session.chat_count/(duration/60):.1f}**개/분\n"
                 f"• 405B 사용: {user_session.model_successes['405B']}회\n"
-                f"• 70B 사용: {user_session.model_successes['70B']}회\n\n"
+                f"• 70B 사용: {user_session.model_successes['70B']}회\n"
+                f"• 토큰: {self.format_usage(user_session.conversation_usage)}\n\n"
                 f"🎮 **다시 시작:** `/start_chat`\n"
                 f"🧠 **모델 통계:** `/model_stats`")
                 
@@ -737,6 +1309,45 @@ class BotChatSystem:
             logger.error(f"메시지 전송 오류 (chat_id: {chat_id}): {e}")
             return False
 
+class SimulationBotChatSystem(BotChatSystem):
+    """텔레그램/HTTP 없이 가상 시계와 교체 가능한 모델 백엔드로 대화 엔진만 실행"""
+    def __init__(self, backend, clock: VirtualClock):
+        super().__init__()
+        self.backend = backend
+        self.now = clock.now
+        self.monotonic = clock.now
+        self.sleep = clock.sleep
+        self.sent_messages = 0
+        self.digest = hashlib.sha256()  # 전송된 메시지 해시 (실행 간 재현성 비교용)
+
+    async def send_message_to_user(self, chat_id: int, message: str, parse_mode: str = 'Markdown') -> bool:
+        self.sent_messages += 1
+        self.digest.update(message.encode('utf-8'))
+        return True
+
+async def run_simulation(turns: int, seed: int, backend):
+    """시드 고정 시뮬레이션으로 대화 엔진의 턴당 오버헤드 측정"""
+    clock = VirtualClock()
+    bot_system = SimulationBotChatSystem(backend, clock)
+    
+    user_session = bot_system.user_sessions[1] = UserSession(1, seed=seed)
+    user_session.nous_api_key = "simulation"
+    user_session.max_messages = turns
+    topic_category, starter_message = bot_system.begin_conversation(user_session)
+    
+    started = time.perf_counter()
+    await bot_system.run_bot_conversation(user_session, starter_message)
+    elapsed = time.perf_counter() - started
+    
+    print(f"🧪 시뮬레이션 (seed={seed}, 주제={topic_category})")
+    print(f"• 턴: {user_session.chat_count:,}개 / 전송 메시지: {bot_system.sent_messages:,}개")
+    print(f"• 실제 소요: {elapsed:.3f}초 ({elapsed / max(user_session.chat_count, 1) * 1e6:.1f}µs/턴, "
+          f"{user_session.chat_count / elapsed if elapsed > 0 else 0:,.0f}턴/초)")
+    print(f"• 가상 시간: {clock.now() / 3600:.1f}시간")
+    print(f"• 405B 성공: {user_session.model_successes['405B']}회 / 70B 성공: {user_session.model_successes['70B']}회")
+    print(f"• 토큰: {user_session.usage.total_tokens:,}개")
+    print(f"• 메시지 해시: {bot_system.digest.hexdigest()[:16]}")
+
 def main():
     """메인 함수"""
     bot_system = BotChatSystem()
@@ -745,27 +1356,146 @@ def main():
         logger.error("TELEGRAM_BOT_TOKEN 환경변수가 설정되지 않았습니다!")
         return
     
+    async def post_init(application: Application):
+        # 이벤트 루프가 시작된 뒤 지연 모니터 실행
+        if bot_system.loop_monitor:
+            bot_system.loop_monitor.start()
+    
+    async def post_shutdown(application: Application):
+        # 종료시 지연 모니터 태스크 정리
+        if bot_system.loop_monitor:
+            await bot_system.loop_monitor.stop()
+    
     # 텔레그램 봇 애플리케이션 생성
-    app = Application.builder().token(bot_system.bot_token).build()
+    app = Application.builder().token(bot_system.bot_token).post_init(post_init).post_shutdown(post_shutdown).build()
     
     # 핸들러 등록
     app.add_handler(CommandHandler("start", bot_system.start_command))
     app.add_handler(CommandHandler("help", bot_system.help_command))
     app.add_handler(CommandHandler("model_stats", bot_system.model_stats_command))
+    app.add_handler(CommandHandler("token_budget", bot_system.token_budget_command))
     app.add_handler(CommandHandler("global_status", bot_system.global_status_command))
     app.add_handler(CommandHandler("start_chat", bot_system.start_chat_command))
     app.add_handler(CommandHandler("stop_chat", bot_system.stop_chat_command))
     app.add_handler(CommandHandler("status", bot_system.status_command))
     app.add_handler(CommandHandler("clear", bot_system.clear_command))
+    app.add_handler(CommandHandler("profile", bot_system.profile_command))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, bot_system.handle_api_key))
     
     # 봇 실행
     logger.info("🚀 스마트 다중 사용자 무한 대화 봇 시작! (405B → 70B 지능형 전환)")
     app.run_polling(drop_pending_updates=True)
 
-if __name__ == '__main__':
-    main()
-    app.run_polling(drop_pending_updates=True)
+class SlowConsoleStream:
+    """쓰기마다 지연이 생기는 콘솔 흉내 (터미널/로그 수집 파이프의 백프레셔)"""
+    def __init__(self, stream, write_delay: float):
+        self.stream = stream
+        self.write_delay = write_delay
+
+    def write(self, text: str):
+        time.sleep(self.write_delay)
+        return self.stream.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+def benchmark_logging(total_turns: int = 20000, workers: int = 50):
+    """로깅 방식별 이벤트 루프 지연 측정 (python main.py --bench-logging 2>/dev/null)"""
+    global log_listener
+    bench_logger = logging.getLogger("bench")
+    root = logging.getLogger()
+    
+    async def measure(sampler: TurnLogSampler):
+        lags = []
+        done = asyncio.Event()
+        
+        async def ticker():
+            # 1ms 주기로 깨어나서 예정보다 늦어진 시간을 기록
+            while not done.is_set():
+                scheduled = time.perf_counter()
+                await asyncio.sleep(0.001)
+                lags.append(time.perf_counter() - scheduled - 0.001)
+        
+        async def worker(chat_id: int):
+            for turn in range(total_turns // workers):
+                if sampler.sample():
+                    bench_logger.info("사용자 %s: 405B 모델 성공", chat_id,
+                                      extra={"chat_id": chat_id, "model": "405B", "latency": 0.0, "turn": turn})
+                await asyncio.sleep(0)
+        
+        ticker_task = asyncio.create_task(ticker())
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(chat_id) for chat_id in range(workers)))
+        elapsed = time.perf_counter() - started
+        done.set()
+        await ticker_task
+        return elapsed, sorted(lags)
+    
+    modes = [
+        ("off", None),
+        ("sync", None),
+        ("queue", 1),
+        ("queue+sample", int(os.getenv('LOG_TURN_SAMPLE', '100'))),
+    ]
+    # 그대로의 stderr와, 쓰기마다 100µs가 걸리는 느린 콘솔 두 가지로 측정
+    sinks = [
+        ("stderr", sys.stderr),
+        ("slow console", SlowConsoleStream(sys.stderr, 0.0001)),
+    ]
+    for sink_name, sink in sinks:
+        print(f"[{sink_name}]", flush=True)
+        for mode, turn_sample in modes:
+            if log_listener:
+                log_listener.stop()
+                log_listener = None
+            logging.disable(logging.NOTSET)
+            if mode == "off":
+                logging.disable(logging.CRITICAL)
+            elif mode == "sync":
+                # 기존 basicConfig 방식: 이벤트 루프에서 직접 콘솔 출력
+                handler = logging.StreamHandler(sink)
+                handler.setFormatter(logging.Formatter(LOG_FORMAT))
+                root.handlers = [handler]
+            else:
+                log_listener = setup_logging(sink)
+            
+            elapsed, lags = asyncio.run(measure(TurnLogSampler(turn_sample or 1)))
+            if log_listener:
+                log_listener.stop()  # 남은 로그를 모두 출력한 뒤 다음 측정
+                log_listener = None
+            
+            lag_ms = [lag * 1000 for lag in lags] or [0.0]
+            print(f"{mode:>13}: {total_turns:,}턴 {elapsed:.3f}초 | 루프 지연 평균 {sum(lag_ms)/len(lag_ms):.3f}ms, "
+                  f"p99 {lag_ms[int(len(lag_ms) * 0.99) - 1]:.3f}ms, 최대 {lag_ms[-1]:.3f}ms", flush=True)
+    logging.disable(logging.NOTSET)
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="스마트 다중 사용자 무한 AI 대화 봇")
+    parser.add_argument('--bench-logging', action='store_true', help="로깅 방식별 이벤트 루프 지연 측정")
+    parser.add_argument('--simulate', type=int, metavar='TURNS', help="텔레그램/API 없이 시드 고정 시뮬레이션 실행")
+    parser.add_argument('--seed', type=int, default=42, help="시뮬레이션 시드")
+    parser.add_argument('--replay', metavar='JSONL', help="기록된 API 응답을 재생 (기본은 고정 응답)")
+    parser.add_argument('--fail-rate-405b', type=float, help="시뮬레이션 405B 실패 비율 (고정 응답 백엔드 전용, 0~1)")
+    args = parser.parse_args()
+    if args.simulate is not None and args.simulate < 1:
+        parser.error("--simulate 값은 1 이상이어야 합니다")
+    if (args.replay or args.fail_rate_405b is not None) and args.simulate is None:
+        parser.error("--replay/--fail-rate-405b는 --simulate와 함께 사용해야 합니다")
+    if args.replay and args.fail_rate_405b is not None:
+        parser.error("--fail-rate-405b는 --replay와 함께 사용할 수 없습니다 (재생 모드는 기록된 응답을 그대로 사용)")
+    if args.fail_rate_405b is not None and not 0 <= args.fail_rate_405b <= 1:
+        parser.error("--fail-rate-405b 값은 0과 1 사이여야 합니다")
+    
+    if args.bench_logging:
+        benchmark_logging()
+    elif args.simulate is not None:
+        if args.replay:
+            try:
+                backend = ReplayModelBackend(args.replay)
+            except (OSError, ValueError) as e:
+                parser.error(f"--replay 파일을 사용할 수 없습니다: {e}")
+        else:
+            backend = CannedModelBackend(seed=args.seed, fail_rate_405b=args.fail_rate_405b or 0.0)
+        asyncio.run(run_simulation(args.simulate, args.seed, backend))
+    else:
+        main()